@@ -2,19 +2,29 @@
 
 """Combine GPT with DuckDuckGo to answer questions."""
 
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import codecs
 import datetime
+import gzip
+import io
 import json
 import re
 import sys
 import textwrap
+import zlib
 
-from bs4 import BeautifulSoup
-from diskcache import Cache
+from diskcache import Cache, Disk
+from diskcache.core import UNKNOWN
 from duckduckgo_search import ddg
-from markdownify import MarkdownConverter
+from lxml import etree
 import appdirs
 import requests
+import urllib3
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 import llmlib
 
@@ -23,31 +33,326 @@ max_token_count = {
     "gpt-3.5-turbo": 4097
 }
 
+# Maximum number of searches (and page fetches) that run at the same time.
+MAX_WORKERS = 8
+
+# Pages are cut off after this many bytes. Anything longer is rarely worth
+# parsing, and would only be trimmed before it is summarized anyway.
+MAX_PAGE_BYTES = 2_000_000
+
+# Room left in the model's context for the summary of the background.
+SUMMARY_TOKENS = 1000
+
+# Content types of pages worth fetching.
+_HTML_TYPES = ("text/html", "application/xhtml+xml")
+
+# Tags whose content is never shown to the reader.
+_SKIP_TAGS = frozenset(("script", "style"))
+
+# Tags that start a new block of text.
+_BLOCK_TAGS = frozenset((
+    "address", "article", "aside", "blockquote", "dd", "div", "dl", "dt",
+    "figcaption", "figure", "footer", "form", "header", "hr", "main", "nav",
+    "ol", "p", "pre", "section", "table", "ul"))
+
+# Tags of table cells, which are separated by " | ".
+_CELL_TAGS = frozenset(("td", "th"))
+
+# Heading tags, and their markdown level.
+_HEADING_TAGS = {f"h{level}": level for level in range(1, 7)}
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Where a page's character encoding is declared: in the Content-Type header,
+# and in a <meta> tag near the start of the page.
+_CONTENT_TYPE_CHARSET = re.compile(r"""charset\s*=\s*["']?([^\s"';]+)""", re.IGNORECASE)
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([\w.:-]+)""", re.IGNORECASE)
+_META_CHARSET_BYTES = 4096
+
+# Byte order marks, and the encodings they mark.
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"))
+
+def _lookup_encoding(name):
+    """Return the name of a codec, or None if Python doesn't know it."""
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def decode_html(html, charset=None):
+    """Decode an HTML document to text.
+
+    Like a browser, this goes by the byte order mark, then by the charset from
+    the Content-Type header, then by a <meta> charset. Failing those, the page
+    is taken to be UTF-8 if it is valid UTF-8, and Windows-1252 otherwise."""
+    for bom, encoding in _BOMS:
+        if html.startswith(bom):
+            return html.decode(encoding, errors="replace")
+    match = _META_CHARSET.search(html, 0, _META_CHARSET_BYTES)
+    meta_charset = match.group(1).decode("ascii") if match else None
+    for name in (charset, meta_charset):
+        encoding = name and _lookup_encoding(name)
+        if encoding:
+            return html.decode(encoding, errors="replace")
+    try:
+        return html.decode("utf-8")
+    except UnicodeDecodeError:
+        return html.decode("windows-1252", errors="replace")
+
+class _MarkdownTarget:
+    """lxml parser target that converts HTML to markdown while it is parsed.
+
+    No tree is built. Scripts and styles are dropped, links and images
+    contribute nothing but their text, and only headings, list items, table
+    rows and cells, preformatted text and paragraph breaks are kept as
+    formatting."""
+    def __init__(self):
+        self.out = io.StringIO()
+        self.skip_depth = 0
+        self.pre_depth = 0
+        # For each list we're in: the number of the last item of an ordered
+        # list, or None for an unordered one.
+        self.lists = []
+        # Formatting owed before the next text: line breaks, markdown to
+        # start the line with, and what separates it from the previous text
+        # on the same line.
+        self.newlines = 0
+        self.prefix = ""
+        self.separator = ""
+
+    def _break(self, newlines, prefix=""):
+        """Start a new line (newlines=1) or paragraph (newlines=2)."""
+        self.newlines = max(self.newlines, newlines)
+        if prefix:
+            self.prefix = prefix
+        self.separator = ""
+
+    def start(self, tag, _attrib):
+        """Called by the parser when a tag is opened."""
+        if tag in _SKIP_TAGS:
+            self.skip_depth += 1
+        elif self.skip_depth:
+            return
+        elif tag in _HEADING_TAGS:
+            self._break(2, "#" * _HEADING_TAGS[tag] + " ")
+        elif tag == "li":
+            if self.lists and self.lists[-1] is not None:
+                self.lists[-1] += 1
+                self._break(1, f"{self.lists[-1]}. ")
+            else:
+                self._break(1, "* ")
+        elif tag in ("br", "tr"):
+            self._break(1)
+        elif tag in _CELL_TAGS:
+            self.separator = " | "
+        elif tag in _BLOCK_TAGS:
+            self._break(2)
+            if tag == "pre":
+                self.pre_depth += 1
+            elif tag == "ol":
+                self.lists.append(0)
+            elif tag == "ul":
+                self.lists.append(None)
+
+    def end(self, tag):
+        """Called by the parser when a tag is closed."""
+        if tag in _SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif self.skip_depth:
+            return
+        elif tag in _HEADING_TAGS or tag in _BLOCK_TAGS:
+            self._break(2)
+            if tag == "pre":
+                self.pre_depth = max(0, self.pre_depth - 1)
+            elif tag in ("ol", "ul") and self.lists:
+                self.lists.pop()
+        elif tag in ("li", "tr"):
+            self._break(1)
+
+    def data(self, data):
+        """Called by the parser for text content."""
+        if self.skip_depth:
+            return
+        if self.pre_depth:
+            # Keep preformatted text, and its indentation, as it is.
+            text = words = data
+        else:
+            text = _WHITESPACE.sub(" ", data)
+            words = text.strip()
+        if not words:
+            if text and not self.newlines:
+                self.separator = self.separator or " "
+            return
+        if self.out.tell():
+            if self.newlines:
+                self.out.write("\n" * self.newlines)
+            elif self.separator or text[0] == " ":
+                self.out.write(self.separator or " ")
+        if self.newlines or not self.out.tell():
+            self.out.write(self.prefix)
+        self.out.write(words)
+        self.newlines = 0
+        self.prefix = ""
+        self.separator = " " if text[-1] == " " and not self.pre_depth else ""
+
+    def close(self):
+        """Called by the parser at the end of the document."""
+        return self.out.getvalue()
+
 def simplify_html(html):
-    """Convert HTML to markdown, removing some tags and links."""
-    soup = BeautifulSoup(html, 'html.parser')
-
-    # Remove unwanted tags
-    for tag in soup.find_all(["script", "style"]):
-        tag.decompose()
-
-    # Remove links. They're not helpful.
-    for tag in soup.find_all("a"):
-        del tag["href"]
-    for tag in soup.find_all("img"):
-        del tag["src"]
-    soup.smooth()
-
-    # Turn HTML into markdown, which is concise but will attempt to
-    # preserve at least some formatting
-    text = MarkdownConverter().convert_soup(soup)
-    text = re.sub(r"\n(\s*\n)+", "\n\n", text)
-    return text
-
-def extract_title(html):
-    """Extract the title from an HTML document."""
-    soup = BeautifulSoup(html, 'html.parser')
-    return soup.title.string
+    """Convert HTML to markdown, removing scripts, styles and links.
+
+    html is text, or bytes that are decoded with decode_html()."""
+    if isinstance(html, bytes):
+        html = decode_html(html)
+    parser = etree.HTMLParser(target=_MarkdownTarget())
+    parser.feed(html)
+    try:
+        return parser.close()
+    except etree.XMLSyntaxError:
+        # Nothing parseable, e.g. an empty document.
+        return ""
+
+class _TitleTarget:
+    """lxml parser target that collects the text of the first <title> tag."""
+    def __init__(self):
+        self.parts = []
+        self.in_title = False
+        self.done = False
+
+    def start(self, tag, _attrib):
+        """Called by the parser when a tag is opened."""
+        if tag == "title" and not self.done:
+            self.in_title = True
+
+    def end(self, tag):
+        """Called by the parser when a tag is closed."""
+        if tag == "title" and self.in_title:
+            self.in_title = False
+            self.done = True
+
+    def data(self, data):
+        """Called by the parser for text content."""
+        if self.in_title:
+            self.parts.append(data)
+
+    def close(self):
+        """Called by the parser at the end of the document."""
+        if not self.parts:
+            return None
+        return "".join(self.parts).strip()
+
+def extract_title(html, chunk_size=4096):
+    """Extract the title from an HTML document.
+
+    The document is fed to the parser in chunks, and parsing stops as soon as
+    the title has been seen, so usually only the head of the document is
+    parsed. Returns None if the document has no title.
+
+    html is text, or bytes that are decoded with decode_html()."""
+    if isinstance(html, bytes):
+        html = decode_html(html)
+    target = _TitleTarget()
+    parser = etree.HTMLParser(target=target)
+    for offset in range(0, len(html), chunk_size):
+        parser.feed(html[offset:offset + chunk_size])
+        if target.done:
+            break
+    try:
+        return parser.close()
+    except etree.XMLSyntaxError:
+        # Nothing parseable, e.g. an empty document.
+        return None
+
+# The decoders below work on bodies that were cut off at MAX_PAGE_BYTES, and
+# stop once they have produced that many bytes.
+
+def _gunzip(data):
+    """Decode the gzip content coding."""
+    return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data, MAX_PAGE_BYTES)
+
+def _inflate(data):
+    """Decode the deflate content coding, with or without a zlib header."""
+    try:
+        return zlib.decompressobj().decompress(data, MAX_PAGE_BYTES)
+    except zlib.error:
+        return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data, MAX_PAGE_BYTES)
+
+def _unbrotli(data):
+    """Decode the br content coding."""
+    decompressor = brotli.Decompressor()
+    parts = []
+    size = 0
+    # Each call stops soon after producing the given number of bytes. If
+    # there is more output, it must be fetched before feeding more input.
+    while size < MAX_PAGE_BYTES:
+        part = decompressor.process(data, output_buffer_limit=MAX_PAGE_BYTES - size)
+        data = b""
+        parts.append(part)
+        size += len(part)
+        if decompressor.is_finished() or decompressor.can_accept_more_data():
+            break
+    return b"".join(parts)[:MAX_PAGE_BYTES]
+
+# Content codings we can decode, and so ask servers for.
+_CONTENT_DECODERS = {
+    "gzip": _gunzip,
+    "deflate": _inflate,
+}
+# Versions of brotli before 1.2 can't limit how much they decompress.
+if brotli and hasattr(brotli.Decompressor, "can_accept_more_data"):
+    _CONTENT_DECODERS["br"] = _unbrotli
+_DECODE_ERRORS = (zlib.error, brotli.error) if brotli else (zlib.error,)
+
+def decode_content(encoding, data):
+    """Undo the Content-Encoding of an HTTP response body."""
+    codings = [coding.strip().lower() for coding in encoding.split(",")]
+    # Codings are listed in the order they were applied.
+    for coding in reversed(codings):
+        if coding in ("", "identity"):
+            continue
+        if coding not in _CONTENT_DECODERS:
+            raise ValueError(f"Unsupported content encoding: {coding}")
+        try:
+            data = _CONTENT_DECODERS[coding](data)
+        except _DECODE_ERRORS as exception:
+            raise ValueError(f"Error decoding {coding} content: {exception}") from exception
+    return data
+
+class CompressedDisk(Disk):
+    """diskcache Disk that stores bytes values (fetched pages) gzip-compressed.
+
+    Compression level 1 is used, which is fast and still shrinks HTML a lot."""
+    def store(self, value, read, key=UNKNOWN):
+        """Compress bytes values before storing them."""
+        if not read and isinstance(value, bytes):
+            value = gzip.compress(value, compresslevel=1)
+        return super().store(value, read, key=key)
+
+    def fetch(self, mode, filename, value, read):
+        """Decompress bytes values after fetching them."""
+        data = super().fetch(mode, filename, value, read)
+        # Values cached before compression was added are stored as is.
+        if not read and isinstance(data, bytes) and data[:2] == b"\x1f\x8b":
+            data = gzip.decompress(data)
+        return data
+
+# A container for ddg_top_hit()'s skip argument, so __contains__ is all it needs.
+class _TakenSources:  # pylint: disable=too-few-public-methods
+    """The URLs that earlier topics took as their source.
+
+    Checking a URL only waits for the earlier topics whose search found it,
+    so topics that found different URLs are fetched concurrently."""
+    def __init__(self, topics):
+        # (set of URLs the topic's search found, future of its top hit)
+        self.topics = topics
+
+    def __contains__(self, url):
+        return any(url in urls and hit_future.result()[0] == url
+                   for urls, hit_future in self.topics)
 
 class GptSearch:
     """Combine GPT with DuckDuckGo to answer questions."""
@@ -55,31 +360,77 @@ class GptSearch:
         self.model = "gpt-3.5-turbo"
         self.verbose = False
 
-        self.cache = Cache(appdirs.user_cache_dir("gpt_search"))
+        self.cache = Cache(appdirs.user_cache_dir("gpt_search"), disk=CompressedDisk)
+
+        # Reuse connections across fetches. Top hits often share a host, so
+        # keep a connection per worker for each host; that way concurrent
+        # fetches from one host never wait for each other.
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = ", ".join(_CONTENT_DECODERS)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16,
+                                                pool_maxsize=MAX_WORKERS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
         self.llm = None
 
     def fetch(self, url):
-        """Fetch a URL, caching the result."""
+        """Fetch a URL, caching the result, and return the page as text.
+
+        If the server compressed the page, it is cached compressed, together
+        with its Content-Encoding and charset, and decoded each time it is
+        returned. Otherwise it is cached as UTF-8, starting with a byte order
+        mark so that it is read back as such."""
         key = ("fetch", url)
         if key in self.cache:
             if self.verbose:
                 print("Cache hit for", key)
-            return self.cache[key]
+            value = self.cache[key]
+            if not isinstance(value, tuple):
+                return decode_html(value)
+            encoding, charset, body = value
+            try:
+                return decode_html(decode_content(encoding, body), charset)
+            except ValueError as exception:
+                # E.g. the page is brotli compressed, but brotli is no longer
+                # installed. Fetch it again.
+                if self.verbose:
+                    print(f"Cannot decode cached {url}: {exception}")
+                del self.cache[key]
 
         try:
-            # Fetch the URL
-            response = requests.get(url, timeout=10)
+            # Fetch the URL, without letting requests decode the body
+            with self.session.get(url, timeout=10, stream=True) as response:
+                # Check if the request was successful
+                if response.status_code != 200:
+                    print(f"Error fetching {url}: {response.status_code}")
+                    return None
+
+                # Don't download PDFs, images and the like.
+                content_type = response.headers.get("Content-Type", "text/html").lower()
+                if not content_type.startswith(_HTML_TYPES):
+                    if self.verbose:
+                        print(f"Skipping {url}: {content_type}")
+                    return None
 
-            # Check if the request was successful
-            if response.status_code != 200:
-                print(f"Error fetching {url}: {response.status_code}")
-                return None
+                body = response.raw.read(MAX_PAGE_BYTES, decode_content=False)
+                encoding = response.headers.get("Content-Encoding", "identity")
+                match = _CONTENT_TYPE_CHARSET.search(content_type)
+                charset = match.group(1) if match else None
 
-            self.cache[key] = response.content
-            return response.content
+            content = decode_content(encoding, body)
+            text = decode_html(content, charset)
+            if content is body:
+                # Not compressed; the cache will compress it.
+                self.cache[key] = codecs.BOM_UTF8 + text.encode("utf-8")
+            else:
+                self.cache[key] = (encoding, charset, body)
+            return text
 
-        except requests.RequestException as exception:
+        # The body is read from the raw urllib3 response, so errors while
+        # reading it aren't wrapped in requests exceptions.
+        except (requests.RequestException, urllib3.exceptions.HTTPError,
+                ValueError) as exception:
             print(f"Error fetching {url}: {exception}")
             return None
 
@@ -99,8 +450,10 @@ class GptSearch:
 
         return result
 
-    def ddg_top_hit(self, topic, skip=()):
-        """Search DuckDuckGo for a topic, and return the top hit."""
+    def ddg_top_hit(self, topic, skip=frozenset()):
+        """Search DuckDuckGo for a topic, and return the top hit.
+
+        Hits whose URL is in `skip` (any container) are ignored."""
         results = self.ddg_search(topic)
         for result in results:
             if result['href'] in skip:
@@ -109,27 +462,57 @@ class GptSearch:
                 print("  Fetching", result['href'])
             html = self.fetch(result['href'])
             if html:
-                title = extract_title(html)
+                title = extract_title(html) or result['title']
                 content = simplify_html(html)
                 if content:
-                    return_value = (result['href'], str(title), content)
+                    return_value = (result['href'], title, content)
                     return return_value
         return (None, None, None)
 
-    def fetch_sources(self, search_prompt):
-        """Fetch sources for a question."""
+    def ddg_top_hits(self, searches):
+        """Search DuckDuckGo for several topics, and return the top hit of each.
+
+        A URL that an earlier topic took as its source is skipped."""
+        # Searches are independent, so run them (and the fetches that
+        # follow) concurrently.
+        with ThreadPoolExecutor(max_workers=min(max(1, len(searches)), MAX_WORKERS)) as executor:
+            search_futures = [executor.submit(self.ddg_search, search) for search in searches]
+            # Each topic's fetch starts as soon as its own search and those of
+            # the topics before it are done, while later searches are still
+            # running.
+            topics = []
+            for search, search_future in zip(searches, search_futures):
+                urls = {result['href'] for result in search_future.result()}
+                hit_future = executor.submit(self.ddg_top_hit, search,
+                                             _TakenSources(list(topics)))
+                topics.append((urls, hit_future))
+            return [hit_future.result() for _, hit_future in topics]
+
+    def fetch_sources(self, search_prompt, summary_prompt=""):
+        """Fetch sources for a question.
+
+        The background is trimmed so that summary_prompt followed by the
+        background fits in one ask, with SUMMARY_TOKENS to spare."""
         search_text = self.llm.ask(search_prompt)
         searches = json.loads(search_text)
-        background_text = ""
-        sources = []
-        for search in searches:
-            source, title, content = self.ddg_top_hit(search,
-                                                      skip=[source for source, _ in sources])
-            if not source:
-                continue
-            background_text += f"# {search}\n\n{content}\n\n"
-            sources.append((source, title))
-        return background_text, sources
+        hits = self.ddg_top_hits(searches)
+        found = [(search, hit) for search, hit in zip(searches, hits) if hit[0]]
+        sources = [(source, title) for _, (source, title, _) in found]
+        # Give each topic an equal share of what the summary prompt, the
+        # headers and the summary itself leave of the model's context. Allow
+        # a few tokens per topic for the blank lines after each page, and for
+        # tokens that merge differently where the parts are joined.
+        headers = [f"# {search}\n\n" for search, _ in found]
+        token_limit = (self.llm.api.max_token_count()
+                       - self.llm.get_num_tokens(summary_prompt)
+                       - SUMMARY_TOKENS
+                       - sum(self.llm.api.token_counts(headers))
+                       - 4 * len(found))
+        token_budget = max(0, token_limit) // max(1, len(found))
+        background = "".join(
+            f"{header}{self.llm.truncate(content, token_budget)}\n\n"
+            for header, (_, (_, _, content)) in zip(headers, found))
+        return background, sources
 
     def main(self):
         """Main function that parses arguments etc."""
@@ -158,12 +541,14 @@ class GptSearch:
                         "# Prompt\n\n"
                         "What 3 Internet search topics would help you answer this "
                         "question? Answer in a JSON list only.")
-        background_text, sources = self.fetch_sources(search_prompt)
+        summary_prompt = (f"{today_prompt}\n\n"
+                          "You provide helpful and complete answers.\n\n"
+                          f"Make a list of facts that would help with: {args.question}\n\n")
+        background_text, sources = self.fetch_sources(search_prompt, summary_prompt)
 
-        background_text = self.llm.summarize(background_text,
-                prompt=f"{today_prompt}\n\n"
-                "You provide helpful and complete answers.\n\n"
-                f"Make a list of facts that would help with: {args.question}\n\n")
+        # The background was trimmed to be summarized in a single ask.
+        if background_text:
+            background_text = self.llm.ask(f"{summary_prompt}{background_text}")
 
         answer = self.llm.ask("\n\n".join([
             "# Background",
@@ -4,183 +4,416 @@ Library that provides basic function for using large language models (LLMs).
 Currently only supports OpenAI.
 """
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import math
 import os
 import re
 import textwrap
+import threading
 
 from diskcache import Cache
 import appdirs
 import openai
+import requests
 import tiktoken
 
+# Separators for splitting text, from the most to the least preferred.
+_TEXT_SEPARATORS = tuple(re.compile(separator, re.MULTILINE) for separator in (
+    r"(\n(?:\s*\n)+)()",
+    r"(\n+)()",
+    r"(\s+)()"))
+
+# Separators for splitting markdown, from the most to the least preferred.
+_MARKDOWN_SEPARATORS = tuple(re.compile(separator, re.MULTILINE) for separator in (
+    r"()(^# .*$)",
+    r"()(^## .*$)",
+    r"()(^### .*$)",
+    r"()(^#### .*$)")) + _TEXT_SEPARATORS
+
 def split_separator(text, separator):
     """Split a text using a separator, but keep the separator in the result.
 
-    Separator must be a regex with two capture groups. The first one is kept
+    Separator must be a regex (a string, which is compiled with re.MULTILINE,
+    or a compiled pattern) with two capture groups. The first one is kept
     with the text before the split, the second one is kept with the text after
     the split."""
+    if isinstance(separator, str):
+        separator = re.compile(separator, re.MULTILINE)
     parts = []
-    remainder = text
-    before_remainder = ""
-    while remainder:
-        split = re.split(separator, remainder, maxsplit=1, flags=re.MULTILINE)
-        if len(split) == 1:
-            parts.append(before_remainder + remainder)
-            break
-        part, after_part, next_before_remainder, next_remainder = split
-        parts.append(before_remainder + part + after_part)
-        remainder = next_remainder
-        before_remainder = next_before_remainder
-    return parts
-
-def quote(text, prefix='> '):
-    """Quote a text, preserving paragraphs and line breaks."""
-    paragraphs = text.splitlines()
-    wrapped_paragraphs = [textwrap.wrap(p) for p in paragraphs]
-    lines = "\n".join("\n".join(p) for p in wrapped_paragraphs)
+    before = ""
+    end = 0
+    for match in separator.finditer(text):
+        parts.append(before + text[end:match.start()] + match.group(1))
+        before = match.group(2)
+        end = match.end()
+    parts.append(before + text[end:])
+    return [part for part in parts if part]
+
+def digest(text):
+    """Return a short digest of a text, for use in cache keys."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def quote(text, prefix='> ', wrap=True):
+    """Quote a text, preserving paragraphs and line breaks.
+
+    If wrap is False, long lines are left as they are, which is much faster
+    for long texts."""
+    if wrap:
+        paragraphs = text.splitlines()
+        wrapped_paragraphs = [textwrap.wrap(p) for p in paragraphs]
+        lines = "\n".join("\n".join(p) for p in wrapped_paragraphs)
+    else:
+        lines = text
     quoted_lines = re.sub(r"^", prefix, lines, flags=re.MULTILINE)
     return quoted_lines
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding for a model.
+
+    Loading an encoding is expensive, so each one is loaded only once and
+    shared by everything that uses the same model."""
+    return tiktoken.encoding_for_model(model)
+
 class Api:
     """Abstract base class for APIs to LLMs."""
     def ask(self, prompt):
         """Ask the model a question."""
         raise NotImplementedError
 
+    def ask_stream(self, prompt):
+        """Ask the model a question, yielding the answer in pieces as they arrive."""
+        yield self.ask(prompt)
+
     def token_count(self, prompt):
         """Return the number of tokens in the prompt."""
         raise NotImplementedError
 
+    def token_counts(self, prompts):
+        """Return the number of tokens in each of the prompts."""
+        return [self.token_count(prompt) for prompt in prompts]
+
     def max_token_count(self):
         """Return the maximum number of tokens that can be sent to the model."""
         raise NotImplementedError
 
+    def truncate(self, text, token_limit):
+        """Return the start of text that fits in token_limit tokens."""
+        raise NotImplementedError
+
 class Openai(Api):
     """API to OpenAI's GPT model."""
-    def __init__(self, model="gpt-3.5-turbo", verbose=False, api_key=None):
+    # Number of token counts to remember before starting over.
+    token_count_cache_size = 4096
+    # Token counts of prompts at least this long are also kept in the disk
+    # cache. Shorter ones are quicker to count again than to look up.
+    token_count_persist_length = 4096
+
+    def __init__(self, model="gpt-3.5-turbo", verbose=False, api_key=None, cache=None):
         openai.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        if openai.requestssession is None and not openai.proxy:
+            # openai keeps a session per thread, and Llm.ask_many() uses new
+            # threads for every batch of questions, so each batch would open
+            # new connections. Share one pool of keep-alive connections.
+            session = requests.Session()
+            session.mount("https://", requests.adapters.HTTPAdapter(
+                max_retries=2, pool_maxsize=Llm.max_concurrent_asks))
+            openai.requestssession = session
         self.model = model
         self.verbose = verbose
+        self.cache = cache if cache is not None else Cache(appdirs.user_cache_dir("llmlib"))
+        # I think this compensates for the overhead in the messages dict.
+        overhead_tokens = 8
+        self._max_token_count = {
+                "gpt-4": 8192,
+                "gpt-3.5-turbo": 4097
+            }.get(self.model, 4096) - overhead_tokens
+        # Token counts of recently seen prompts. They're keyed by (length,
+        # hash) so that the (possibly long) prompts aren't kept around.
+        self._token_counts = {}
+
+    @property
+    def encoding(self):
+        """The tiktoken encoding for this model."""
+        return get_encoding(self.model)
 
     def ask(self, prompt):
         """Ask the model a question."""
+        response = self._create(prompt, stream=False)
+        return response.choices[0]['message']['content']
+
+    def ask_stream(self, prompt):
+        """Ask the model a question, yielding the answer in pieces as they arrive."""
+        for chunk in self._create(prompt, stream=True):
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0]['delta'].get('content')
+            if content:
+                yield content
+
+    def _create(self, prompt, stream):
+        """Send the prompt to the chat completion API."""
         try:
-            response = openai.ChatCompletion.create(
+            return openai.ChatCompletion.create(
                 model=self.model,
                 messages=[
                     {"role": "user", "content": prompt}
-                ]
+                ],
+                stream=stream
             )
-            result = response.choices[0]['message']['content']
         except openai.error.InvalidRequestError as exception:
             exception._message += f"; computed token length={self.token_count(prompt)}"
             raise
-        return result
 
     def token_count(self, prompt):
         """Return the number of tokens in the prompt."""
-        enc = tiktoken.encoding_for_model(self.model)
-        return len(enc.encode(prompt))
+        return self.token_counts([prompt])[0]
+
+    def token_counts(self, prompts):
+        """Return the number of tokens in each of the prompts."""
+        keys = [(len(prompt), hash(prompt)) for prompt in prompts]
+        counts = {key: self._token_counts[key] for key in keys if key in self._token_counts}
+        missing = {key: prompt for key, prompt in zip(keys, prompts) if key not in counts}
+        if missing:
+            counts.update(self._count_tokens(missing))
+            if len(self._token_counts) + len(missing) > self.token_count_cache_size:
+                self._token_counts.clear()
+            for key in missing:
+                self._token_counts[key] = counts[key]
+        return [counts[key] for key in keys]
+
+    def _count_tokens(self, prompts):
+        """Count the tokens in a dict of prompts, returning a dict of counts.
+
+        Counts of long prompts are looked up in, and added to, the disk cache."""
+        counts = {}
+        cache_keys = {key: ("token_count", self.model, digest(prompt))
+                      for key, prompt in prompts.items()
+                      if len(prompt) >= self.token_count_persist_length}
+        for key, cache_key in cache_keys.items():
+            count = self.cache.get(cache_key)
+            if count is not None:
+                counts[key] = count
+        to_encode = {key: prompt for key, prompt in prompts.items() if key not in counts}
+
+        if len(to_encode) == 1:
+            (key, prompt), = to_encode.items()
+            counts[key] = len(self.encoding.encode_ordinary(prompt))
+        elif to_encode:
+            # tiktoken encodes a batch on several threads, without holding the GIL.
+            encoded = self.encoding.encode_ordinary_batch(list(to_encode.values()),
+                                                          num_threads=os.cpu_count())
+            counts.update(zip(to_encode, (len(tokens) for tokens in encoded)))
+
+        to_persist = [key for key in to_encode if key in cache_keys]
+        if to_persist:
+            with self.cache.transact():
+                for key in to_persist:
+                    self.cache[cache_keys[key]] = counts[key]
+        return counts
+
+    def truncate(self, text, token_limit):
+        """Return the start of text that fits in token_limit tokens."""
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) <= token_limit:
+            return text
+        return self.encoding.decode(tokens[:token_limit])
 
     def max_token_count(self):
         """Return the maximum number of tokens that can be sent to the model."""
-        # I think this compensates for the overhead in the messages dict.
-        overhead_tokens = 8
-        return {
-                "gpt-4": 8192,
-                "gpt-3.5-turbo": 4097
-            }.get(self.model, 4096) - overhead_tokens
+        return self._max_token_count
 
     def __repr__(self) -> str:
         return f"Openai({self.model})"
 
-class Llm:
+# Besides its state, Llm keeps the strings every ask() needs, so that they are
+# only built once.
+class Llm:  # pylint: disable=too-many-instance-attributes
     """Interface to a large language model (LLM)."""
+    # Maximum number of questions that are asked at the same time.
+    max_concurrent_asks = 8
+    # No real text averages more characters per token than this.
+    max_chars_per_token = 8
+
     def __init__(self, api : Api, verbose=False):
         self.api = api
         self.verbose = verbose
-        self.cache = Cache(appdirs.user_cache_dir("llmlib"))
-        self.counters = {}
+        # Share the API's cache if it has one, instead of opening the same
+        # directory a second time.
+        self.cache = getattr(api, "cache", None)
+        if self.cache is None:
+            self.cache = Cache(appdirs.user_cache_dir("llmlib"))
+        self.counters = defaultdict(int)
+        # ask() may be called from several threads. This protects the
+        # counters.
+        self.lock = threading.Lock()
+        # Used on every ask(), so only build these once.
+        self.api_repr = repr(self.api)
+        self.ask_counter = f"ask {self.api_repr}"
+        self.ask_hit_counter = f"ask-hit {self.api_repr}"
+        self.ask_miss_counter = f"ask-miss {self.api_repr}"
         log_dir = appdirs.user_log_dir("llmlib")
         log_path = os.path.join(log_dir, "log.txt")
         if self.verbose:
             print(f"Logging to {log_path}")
         os.makedirs(log_dir, exist_ok=True)
-        # pylint: disable-msg=consider-using-with
-        self.log_fd = open(log_path, "a", encoding="utf-8")
+        self.log_fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
 
     def _log(self, text : str):
-        """Log text to the log file."""
-        self.log_fd.write(text)
+        """Log text to the log file.
+
+        Each call is a single write to a file opened for appending, so the
+        text of one call is never mixed up with that of calls from other
+        threads. Text that belongs together must be logged in one call."""
         if not text.endswith("\n"):
-            self.log_fd.write("\n")
+            text += "\n"
+        os.write(self.log_fd, text.encode("utf-8"))
 
     def ask(self, prompt : str):
         """Ask the model a question."""
-        self._log(f"\nAsk {self.api!r}:\n{quote(prompt)}")
         if self.verbose:
-            print(f"Ask {self.api!r}: {prompt[:60]!r}")
+            print(f"Ask {self.api_repr}: {prompt[:60]!r}")
 
         assert len(prompt) > 25
 
-        cache_key = ("ask", repr(self.api), prompt)
+        # Key on a digest of the prompt rather than the prompt itself, which
+        # can be many kilobytes long.
+        cache_key = ("ask", self.api_repr, digest(prompt))
         result = self.cache.get(cache_key)
-        self._increment_counter(f"ask {self.api!r}")
 
         if result:
-            self._increment_counter(f"ask-hit {self.api!r}")
+            self._increment_counter(self.ask_counter, self.ask_hit_counter)
             cached = " (cached)"
         else:
-            self._increment_counter(f"ask-miss {self.api!r}")
-            result = self.api.ask(prompt)
+            self._increment_counter(self.ask_counter, self.ask_miss_counter)
+            try:
+                result = self.api.ask(prompt)
+            except Exception as exception:
+                # The prompt is most worth seeing when it was rejected, e.g.
+                # for being too long.
+                self._log(f"\nAsk {self.api_repr}:\n{quote(prompt, wrap=False)}\n"
+                          f"\nFailed:\n{quote(repr(exception), wrap=False)}")
+                raise
+            self.cache[cache_key] = result
             cached = ""
 
-        self._log(f"\nResponse{cached}:\n{quote(result)}")
+        # Log the question and answer together, so that answers to questions
+        # asked at the same time can't end up under the wrong question.
+        self._log(f"\nAsk {self.api_repr}:\n{quote(prompt, wrap=False)}\n"
+                  f"\nResponse{cached}:\n{quote(result, wrap=False)}")
         if self.verbose:
             print(f"Response{cached}: {result[:60]!r}")
 
-        self.cache[cache_key] = result
-
         return result
 
-    def _increment_counter(self, name):
-        """Increment a counter."""
-        self.counters.setdefault(name, 0)
-        self.counters[name] += 1
+    def ask_many(self, prompts):
+        """Ask the model several questions, returning the answers in order.
+
+        Up to max_concurrent_asks questions are asked at the same time."""
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_asks) as executor:
+            return list(executor.map(self.ask, prompts))
+
+    def _increment_counter(self, *names):
+        """Increment one or more counters."""
+        with self.lock:
+            for name in names:
+                self.counters[name] += 1
 
     def split_markdown(self, text, token_limit=None):
         """Split a markdown text to fit the given token limit."""
         return self.split_text(text, token_limit=token_limit,
-                               separators=(
-                                   r"()(^# .*$)",
-                                   r"()(^## .*$)",
-                                   r"()(^### .*$)",
-                                   r"()(^#### .*$)",
-                                   r"(\n(?:\s*\n)+)",
-                                   r"(\n+)",
-                                   r"(\s+)"))
-
-    def split_text(self, text, token_limit=None,
-                   separators=(r"(\n(?:\s*\n)+)()", r"(\n+)()", r"(\s+)()")):
+                               separators=_MARKDOWN_SEPARATORS)
+
+    def split_text(self, text, token_limit=None, separators=_TEXT_SEPARATORS):
         """Split a text into parts which each fit the given token limit."""
         if token_limit is None:
             token_limit = self.api.max_token_count()
 
-        # Split text into parts that are each short enough to fit the token limit.
-        short_parts = []
-        for part in split_separator(text, separators[0]):
-            if self.api.token_count(part) > token_limit:
-                short_parts.extend(self.split_text(part, token_limit, separators[1:]))
-            else:
-                short_parts.append(part)
+        # Split text into parts that are each short enough to fit the token
+        # limit. This is done one separator at a time, so that all the pieces
+        # on one level are counted in a single batch. Each node is a list of
+        # (piece, token count) pairs and of child nodes, which replace pieces
+        # that were too long and had to be split further.
+        root = []
+        nodes = [root]
+        pending = [(root, text)]
+        for level, separator in enumerate(separators):
+            pending = self._split_level(pending, separator, token_limit,
+                                        last_level=level == len(separators) - 1)
+            nodes.extend(node for node, _ in pending)
+            if not pending:
+                break
 
-        # Combine short parts into longer ones that still fit the token limit.
+        # Combine short parts into longer ones that still fit the token limit,
+        # from the deepest nodes up.
+        for node in reversed(nodes):
+            node[:] = self._combine(node, token_limit)
+        return [part for part, _ in root]
+
+    def _split_level(self, pending, separator, token_limit, last_level):
+        """Split the text of each (node, text) pair at separator, for split_text().
+
+        The pieces are counted in a single batch and added to their node.
+        Returns (child node, piece) pairs for the pieces that are too long and
+        have to be split further."""
+        splits = [split_separator(piece, separator) for _, piece in pending]
+        # Pieces this long are split further without counting their tokens;
+        # they won't fit. On the last level there is nothing left to split
+        # them with, so everything is counted.
+        long_length = math.inf if last_level else token_limit * self.max_chars_per_token
+        counts = iter(self.api.token_counts([piece for split in splits for piece in split
+                                             if len(piece) <= long_length]))
+        next_pending = []
+        for (node, _), split in zip(pending, splits):
+            for piece in split:
+                count = next(counts) if len(piece) <= long_length else math.inf
+                if count > token_limit and not last_level:
+                    child = []
+                    node.append(child)
+                    next_pending.append((child, piece))
+                else:
+                    node.append((piece, count))
+        return next_pending
+
+    def _combine(self, node, token_limit):
+        """Combine the parts of a split_text() node into as few as fit token_limit.
+
+        Returns a list of (part, token count) pairs. Parts are grouped by the
+        sum of their token counts, and each group is counted again once it is
+        joined: the tokenizer can split the text around a separator
+        differently when the pieces are joined (e.g. "x  " and "123" are 3
+        tokens apart, but "x  123" is 4), so the sum is only an estimate. The
+        rare group that then turns out too long is split in two."""
+        short_parts = [part for entry in node
+                       for part in (entry if isinstance(entry, list) else [entry])]
+        groups = []
+        group = []
+        group_count = 0
+        for part, count in short_parts:
+            if group and group_count + count > token_limit:
+                groups.append(group)
+                group = []
+                group_count = 0
+            group.append(part)
+            group_count += count
+        if group:
+            groups.append(group)
+        texts = ["".join(group) for group in groups]
+        pending = list(zip(groups, texts, self.api.token_counts(texts)))
+        pending.reverse()
         parts = []
-        for part in short_parts:
-            if parts and self.api.token_count(parts[-1] + part) <= token_limit:
-                parts[-1] += part
-            else:
-                parts.append(part)
+        while pending:
+            group, text, count = pending.pop()
+            if count <= token_limit or len(group) == 1:
+                parts.append((text, count))
+                continue
+            middle = len(group) // 2
+            for half in (group[middle:], group[:middle]):
+                text = "".join(half)
+                pending.append((half, text, self.api.token_count(text)))
         return parts
 
     def summarize(self, text, token_limit=None, prompt="Summarize:", max_iterations=10):
@@ -193,9 +426,9 @@ class Llm:
         for _ in range(max_iterations):
             if self.api.token_count(text) <= token_limit:
                 break
-            text = "\n\n".join(
-                self.ask(f"{prompt} {part}")
-                for part in self.split_text(text, token_limit=token_limit))
+            text = "\n\n".join(self.ask_many(
+                f"{prompt} {part}"
+                for part in self.split_text(text, token_limit=token_limit)))
         return text
 
     def counter_string(self, pattern="^ask "):
@@ -208,3 +441,7 @@ class Llm:
     def get_num_tokens(self, text):
         """Return the number of tokens in the text."""
         return self.api.token_count(text)
+
+    def truncate(self, text, token_limit):
+        """Return the start of text that fits in token_limit tokens."""
+        return self.api.truncate(text, token_limit)